@@ -1,18 +1,100 @@
 from __future__ import annotations
 
+import atexit
+import functools
 import os
+import queue
+import signal
 import sqlite3
-import subprocess
 import sys
+import threading
+from collections import OrderedDict
+from contextlib import closing
 from dataclasses import dataclass
+from typing import Callable, TypeVar
 
 from flask import Flask, redirect, render_template, request, session, url_for
 
+if sys.version_info < (3, 10):
+    raise SystemExit("Shop Management System requires Python 3.10 or newer.")
+if sqlite3.sqlite_version_info < (3, 35, 0):
+    raise SystemExit(
+        "Shop Management System requires SQLite 3.35 or newer "
+        f"(found {sqlite3.sqlite_version})."
+    )
 
 DATABASE_PATH = os.path.join("instance", "shop.db")
-
-
-@dataclass
+IN_MEMORY = os.environ.get("SHOP_IN_MEMORY") == "1"
+DASHBOARD_TEMPLATES = {
+    "admin": "dashboard_admin.html",
+    "worker": "dashboard_worker.html",
+}
+
+SQL_SELECT_ITEMS = """
+SELECT id, name, price, quantity
+FROM items
+WHERE shop_id = ?
+ORDER BY id DESC
+"""
+SQL_SELECT_ITEM = "SELECT id, name, price, quantity FROM items WHERE id = ?"
+SQL_SELECT_SHOP_ITEM = (
+    "SELECT id, name, price, quantity FROM items WHERE id = ? AND shop_id = ?"
+)
+SQL_SELECT_SALES = """
+SELECT sales.id, items.name, sales.quantity, sales.total, sales.created_at, users.username
+FROM sales
+JOIN items ON items.id = sales.item_id
+JOIN users ON users.id = sales.user_id
+WHERE sales.shop_id = ?
+ORDER BY sales.created_at DESC
+"""
+SQL_INSERT_ITEM = (
+    "INSERT INTO items (shop_id, name, price, quantity) VALUES (?, ?, ?, ?)"
+)
+SQL_UPDATE_ITEM = """
+UPDATE items
+SET name = ?, price = ?, quantity = ?
+WHERE id = ?
+"""
+SQL_SELL_ITEM_STOCK = """
+UPDATE items
+SET quantity = quantity - ?
+WHERE id = ? AND shop_id = ? AND quantity >= ?
+RETURNING price
+"""
+SQL_INSERT_SALE = """
+INSERT INTO sales (shop_id, item_id, user_id, quantity, total)
+VALUES (?, ?, ?, ?, ?)
+"""
+SQL_DELETE_ITEM = "DELETE FROM items WHERE id = ?"
+SQL_SELECT_USER = "SELECT id, username, role FROM users WHERE id = ?"
+SQL_SELECT_USER_BY_CREDENTIALS = (
+    "SELECT id, username, role FROM users WHERE username = ? AND password = ?"
+)
+SQL_INSERT_SHOP = "INSERT OR IGNORE INTO shops (name) VALUES (?)"
+SQL_SELECT_SHOPS = "SELECT id, name FROM shops ORDER BY name"
+SQL_INSERT_WORKER = (
+    "INSERT OR IGNORE INTO users (username, password, role) VALUES (?, ?, 'worker')"
+)
+SQL_SELECT_WORKERS = (
+    "SELECT id, username FROM users WHERE role = 'worker' ORDER BY username"
+)
+
+POOL_SIZE = 8
+QUERY_CACHE_SIZE = 128
+MEMORY_LOCK_TIMEOUT = 10
+
+_local = threading.local()
+_idle_connections: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(POOL_SIZE)
+_memory_connection: sqlite3.Connection | None = None
+_memory_lock = threading.Lock()
+_query_cache: OrderedDict[tuple[object, ...], tuple[tuple[object, ...], object]] = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+T = TypeVar("T")
+
+
+@dataclass(slots=True, frozen=True)
 class Item:
     id: int
     name: str
@@ -20,15 +102,134 @@ class Item:
     quantity: int
 
 
-def get_connection() -> sqlite3.Connection:
+def open_connection() -> sqlite3.Connection:
     os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
-    connection = sqlite3.connect(DATABASE_PATH)
+    # Pooled connections are handed from one request thread to the next.
+    connection = sqlite3.connect(
+        ":memory:" if IN_MEMORY else DATABASE_PATH,
+        cached_statements=256,
+        isolation_level=None,
+        check_same_thread=False,
+    )
+    if IN_MEMORY and os.path.exists(DATABASE_PATH):
+        with closing(sqlite3.connect(DATABASE_PATH)) as disk:
+            disk.backup(connection)
     connection.row_factory = sqlite3.Row
+    connection.executescript(
+        """
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -65536;
+        PRAGMA mmap_size = 268435456;
+        """
+    )
+    return connection
+
+
+def get_connection() -> sqlite3.Connection:
+    # The connection checked out by this thread is reused until
+    # release_connection() hands it back to the pool; `with connection:` only
+    # scopes a transaction, it does not close the handle. In memory mode
+    # there is a single connection and checking it out holds _memory_lock,
+    # so requests take turns.
+    global _memory_connection
+    connection = getattr(_local, "connection", None)
+    if connection is not None:
+        return connection
+    if IN_MEMORY:
+        _memory_lock.acquire()
+        if _memory_connection is None:
+            _memory_connection = open_connection()
+        connection = _memory_connection
+    else:
+        try:
+            connection = _idle_connections.get_nowait()
+        except queue.Empty:
+            connection = open_connection()
+    _local.connection = connection
     return connection
 
 
+def release_connection(exception: BaseException | None = None) -> None:
+    connection = _local.__dict__.pop("connection", None)
+    if connection is None:
+        return
+    if connection.in_transaction:
+        connection.rollback()
+    if IN_MEMORY:
+        _memory_lock.release()
+        return
+    try:
+        _idle_connections.put_nowait(connection)
+    except queue.Full:
+        connection.close()
+
+
+@atexit.register
+def close_connections() -> None:
+    global _memory_connection
+    release_connection()
+    if IN_MEMORY:
+        # A request stuck holding the connection must not stop the write-back;
+        # after the timeout, save whatever the connection holds.
+        locked = _memory_lock.acquire(timeout=MEMORY_LOCK_TIMEOUT)
+        try:
+            if _memory_connection is not None:
+                with closing(sqlite3.connect(DATABASE_PATH)) as disk:
+                    _memory_connection.backup(disk)
+                _memory_connection.close()
+                _memory_connection = None
+        finally:
+            if locked:
+                _memory_lock.release()
+        return
+    while True:
+        try:
+            _idle_connections.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+def handle_sigterm(signum: int, frame: object) -> None:
+    # Exit normally so close_connections() runs; systemctl stop and restart
+    # send SIGTERM, which otherwise skips atexit handlers.
+    sys.exit(0)
+
+
+def cached_until_write(func: Callable[..., T]) -> Callable[..., T]:
+    # PRAGMA data_version moves when another connection commits and
+    # total_changes moves when this one writes. Both are only comparable on
+    # the same connection, so an entry is served only to the connection that
+    # stored it, and only while neither counter has moved.
+    @functools.wraps(func)
+    def wrapper(*args: object) -> T:
+        connection = get_connection()
+        version = (
+            connection,
+            connection.execute("PRAGMA data_version").fetchone()[0],
+            connection.total_changes,
+        )
+        key = (func.__name__, args)
+        with _query_cache_lock:
+            cached = _query_cache.get(key)
+            if cached is not None and cached[0] == version:
+                _query_cache.move_to_end(key)
+                return cached[1]
+        result = func(*args)
+        with _query_cache_lock:
+            _query_cache[key] = (version, result)
+            _query_cache.move_to_end(key)
+            if len(_query_cache) > QUERY_CACHE_SIZE:
+                _query_cache.popitem(last=False)
+        return result
+
+    return wrapper
+
+
 def init_db() -> None:
     with get_connection() as connection:
+        connection.execute("BEGIN")
         connection.execute(
             """
             CREATE TABLE IF NOT EXISTS shops (
@@ -88,6 +289,15 @@ def init_db() -> None:
             )
             """
         )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_items_shop_id ON items(shop_id)"
+        )
+        connection.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_sales_shop_id_created_at
+            ON sales(shop_id, created_at DESC)
+            """
+        )
         existing_admin = connection.execute(
             "SELECT id FROM users WHERE role = 'admin' LIMIT 1"
         ).fetchone()
@@ -99,70 +309,75 @@ def init_db() -> None:
         connection.commit()
 
 
-def fetch_items(shop_id: int | None) -> list[Item]:
+@cached_until_write
+def fetch_items(shop_id: int | None) -> list[sqlite3.Row]:
     if shop_id is None:
         return []
     with get_connection() as connection:
-        rows = connection.execute(
-            """
-            SELECT id, name, price, quantity
-            FROM items
-            WHERE shop_id = ?
-            ORDER BY id DESC
-            """,
-            (shop_id,),
-        ).fetchall()
-    return [Item(**row) for row in rows]
+        return connection.execute(SQL_SELECT_ITEMS, (shop_id,)).fetchall()
 
 
 def fetch_item(item_id: int, shop_id: int | None = None) -> Item | None:
     with get_connection() as connection:
         if shop_id is None:
-            row = connection.execute(
-                "SELECT id, name, price, quantity FROM items WHERE id = ?",
-                (item_id,),
-            ).fetchone()
+            row = connection.execute(SQL_SELECT_ITEM, (item_id,)).fetchone()
         else:
-            row = connection.execute(
-                "SELECT id, name, price, quantity FROM items WHERE id = ? AND shop_id = ?",
-                (item_id, shop_id),
-            ).fetchone()
+            row = connection.execute(SQL_SELECT_SHOP_ITEM, (item_id, shop_id)).fetchone()
     if row is None:
         return None
-    return Item(**row)
+    return Item(*row)
+
+
+@cached_until_write
+def fetch_sales(shop_id: int) -> list[sqlite3.Row]:
+    with get_connection() as connection:
+        return connection.execute(SQL_SELECT_SALES, (shop_id,)).fetchall()
 
 
 def create_item(shop_id: int, name: str, price: float, quantity: int) -> None:
     with get_connection() as connection:
-        connection.execute(
-            "INSERT INTO items (shop_id, name, price, quantity) VALUES (?, ?, ?, ?)",
-            (shop_id, name, price, quantity),
-        )
-        connection.commit()
+        connection.execute(SQL_INSERT_ITEM, (shop_id, name, price, quantity))
 
 
 def update_item(item_id: int, name: str, price: float, quantity: int) -> None:
     with get_connection() as connection:
+        connection.execute(SQL_UPDATE_ITEM, (name, price, quantity, item_id))
+
+
+def record_sale(shop_id: int, item_id: int, user_id: int, quantity: int) -> bool:
+    connection = get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            SQL_SELL_ITEM_STOCK,
+            (quantity, item_id, shop_id, quantity),
+        ).fetchone()
+        if row is None:
+            connection.rollback()
+            return False
         connection.execute(
-            """
-            UPDATE items
-            SET name = ?, price = ?, quantity = ?
-            WHERE id = ?
-            """,
-            (name, price, quantity, item_id),
+            SQL_INSERT_SALE,
+            (shop_id, item_id, user_id, quantity, row["price"] * quantity),
         )
-        connection.commit()
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+    connection.commit()
+    return True
 
 
 def delete_item(item_id: int) -> None:
     with get_connection() as connection:
-        connection.execute("DELETE FROM items WHERE id = ?", (item_id,))
-        connection.commit()
+        connection.execute(SQL_DELETE_ITEM, (item_id,))
 
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "change-me")
-init_db()
+app.teardown_appcontext(release_connection)
+if IN_MEMORY and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGTERM, handle_sigterm)
+with app.app_context():
+    init_db()
 
 
 def get_current_user() -> sqlite3.Row | None:
@@ -170,10 +385,7 @@ def get_current_user() -> sqlite3.Row | None:
     if user_id is None:
         return None
     with get_connection() as connection:
-        return connection.execute(
-            "SELECT id, username, role FROM users WHERE id = ?",
-            (user_id,),
-        ).fetchone()
+        return connection.execute(SQL_SELECT_USER, (user_id,)).fetchone()
 
 
 def require_login() -> sqlite3.Row | None:
@@ -218,6 +430,8 @@ def index() -> str:
 
 
 def run_updates() -> tuple[bool, str]:
+    import subprocess
+
     repo_dir = os.path.dirname(os.path.abspath(__file__))
     git_result = subprocess.run(
         ["git", "-C", repo_dir, "pull", "--ff-only"],
@@ -301,10 +515,9 @@ def sell_item() -> str:
         return redirect(url_for("shops"))
     items = fetch_items(shop_id)
     if request.method == "POST":
-        try:
-            item_id = int(request.form["item_id"])
-            quantity = int(request.form["quantity"])
-        except (TypeError, ValueError):
+        item_id = request.form.get("item_id", type=int)
+        quantity = request.form.get("quantity", type=int)
+        if item_id is None or quantity is None:
             return redirect(
                 url_for(
                     "index",
@@ -312,15 +525,6 @@ def sell_item() -> str:
                     sell_ok="false",
                 )
             )
-        item = fetch_item(item_id, shop_id)
-        if item is None:
-            return redirect(
-                url_for(
-                    "index",
-                    sell_status="Selected item not found.",
-                    sell_ok="false",
-                )
-            )
         if quantity <= 0:
             return redirect(
                 url_for(
@@ -329,7 +533,15 @@ def sell_item() -> str:
                     sell_ok="false",
                 )
             )
-        if quantity > item.quantity:
+        if not record_sale(shop_id, item_id, user["id"], quantity):
+            if fetch_item(item_id, shop_id) is None:
+                return redirect(
+                    url_for(
+                        "index",
+                        sell_status="Selected item not found.",
+                        sell_ok="false",
+                    )
+                )
             return redirect(
                 url_for(
                     "index",
@@ -337,16 +549,6 @@ def sell_item() -> str:
                     sell_ok="false",
                 )
             )
-        update_item(item.id, item.name, item.price, item.quantity - quantity)
-        with get_connection() as connection:
-            connection.execute(
-                """
-                INSERT INTO sales (shop_id, item_id, user_id, quantity, total)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (shop_id, item.id, user["id"], quantity, item.price * quantity),
-            )
-            connection.commit()
         return redirect(
             url_for(
                 "index",
@@ -364,7 +566,7 @@ def login() -> str:
         password = request.form["password"].strip()
         with get_connection() as connection:
             user = connection.execute(
-                "SELECT id, username, role FROM users WHERE username = ? AND password = ?",
+                SQL_SELECT_USER_BY_CREDENTIALS,
                 (username, password),
             ).fetchone()
         if user is None:
@@ -386,9 +588,7 @@ def dashboard() -> str:
     if user is None:
         return redirect(url_for("login"))
     shop_id = get_current_shop_id()
-    if user["role"] == "admin":
-        return render_template("dashboard_admin.html", user=user, shop_id=shop_id)
-    return render_template("dashboard_worker.html", user=user, shop_id=shop_id)
+    return render_template(DASHBOARD_TEMPLATES[user["role"]], user=user, shop_id=shop_id)
 
 
 @app.route("/shops", methods=["GET", "POST"])
@@ -400,10 +600,9 @@ def shops() -> str:
         name = request.form["name"].strip()
         if name:
             with get_connection() as connection:
-                connection.execute("INSERT OR IGNORE INTO shops (name) VALUES (?)", (name,))
-                connection.commit()
+                connection.execute(SQL_INSERT_SHOP, (name,))
     with get_connection() as connection:
-        shops_list = connection.execute("SELECT id, name FROM shops ORDER BY name").fetchall()
+        shops_list = connection.execute(SQL_SELECT_SHOPS).fetchall()
     return render_template(
         "shops.html",
         user=user,
@@ -434,15 +633,9 @@ def workers() -> str:
         password = request.form["password"].strip()
         if username and password:
             with get_connection() as connection:
-                connection.execute(
-                    "INSERT OR IGNORE INTO users (username, password, role) VALUES (?, ?, 'worker')",
-                    (username, password),
-                )
-                connection.commit()
+                connection.execute(SQL_INSERT_WORKER, (username, password))
     with get_connection() as connection:
-        workers_list = connection.execute(
-            "SELECT id, username FROM users WHERE role = 'worker' ORDER BY username"
-        ).fetchall()
+        workers_list = connection.execute(SQL_SELECT_WORKERS).fetchall()
     return render_template(
         "workers.html",
         user=user,
@@ -459,23 +652,11 @@ def sales_report() -> str:
     shop_id = get_current_shop_id()
     if shop_id is None:
         return redirect(url_for("shops"))
-    with get_connection() as connection:
-        sales = connection.execute(
-            """
-            SELECT sales.id, items.name, sales.quantity, sales.total, sales.created_at, users.username
-            FROM sales
-            JOIN items ON items.id = sales.item_id
-            JOIN users ON users.id = sales.user_id
-            WHERE sales.shop_id = ?
-            ORDER BY sales.created_at DESC
-            """,
-            (shop_id,),
-        ).fetchall()
     return render_template(
         "sales_report.html",
         user=user,
         shop_id=shop_id,
-        sales=sales,
+        sales=fetch_sales(shop_id),
     )
 
 
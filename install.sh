@@ -34,6 +34,16 @@ APP_PORT="$(prompt_value "Port for web UI [8000]: " "8000")"
 $SUDO apt-get update
 $SUDO apt-get install -y git python3 python3-venv
 
+if ! python3 -c 'import sys; sys.exit(sys.version_info < (3, 10))'; then
+  echo "Python 3.10 or newer is required (found $(python3 --version 2>&1))." >&2
+  exit 1
+fi
+
+if ! python3 -c 'import sqlite3, sys; sys.exit(sqlite3.sqlite_version_info < (3, 35, 0))'; then
+  echo "SQLite 3.35 or newer is required (found $(python3 -c 'import sqlite3; print(sqlite3.sqlite_version)'))." >&2
+  exit 1
+fi
+
 if [[ -d "${APP_DIR}/.git" ]]; then
   $SUDO git -C "$APP_DIR" pull --ff-only
 else